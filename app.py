@@ -10,8 +10,17 @@
 
 import os
 import json
+import sqlite3
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson
+except ImportError:  # fall back to stdlib json where orjson isn't available
+    orjson = None
+
 from flask import Flask, render_template, request, flash, redirect, url_for, jsonify
-from flask_caching import Cache
 from flask_cors import CORS, cross_origin
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
@@ -20,57 +29,137 @@ from story_generator import generate_content, process_text
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'fallback_secret_key'
-app.config['CACHE_TYPE'] = 'simple'
 cors = CORS(app)
 app.config['CORS_HEADERS'] = 'Content-Type'
 
-cache = Cache(app)
 #limiter = Limiter(get_remote_address, app=app, default_limits=["200 per day", "50 per hour"])
 
-STORYBOOKS_FILE = 'storybooks.json'
+STORYBOOKS_DB = 'storybooks.db'
+LEGACY_STORYBOOKS_FILE = 'storybooks.json'
+LEGACY_STORYBOOKS_JSONL = 'storybooks.jsonl'
+
+# Single shared SQLite connection; WAL lets readers run alongside the
+# writer and the lock serializes statement execution across threads
+DB_CONN = None
+STORYBOOKS_LOCK = threading.Lock()
+
+# Background pool for story generation so HTTP workers aren't held for
+# the 5-30s an LLM + image pipeline takes; clients poll /status/<job_id>.
+# Job state lives in the jobs table so polls can land on any worker.
+STORY_EXECUTOR = ThreadPoolExecutor(max_workers=2)
+
+def json_loads(data):
+    '''- Parses JSON with orjson when available, stdlib json otherwise'''
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def json_dumps(obj):
+    '''- Serializes to JSON bytes with orjson when available, stdlib json otherwise'''
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+def migrate_legacy_storybooks(conn):
+    '''
+    - One-time import of storybooks from the old JSONL/JSON files
+    - Runs only while the storybooks table is empty
+    '''
+    if conn.execute('SELECT 1 FROM storybooks LIMIT 1').fetchone() is not None:
+        return
+    legacy = []
+    try:
+        if os.path.exists(LEGACY_STORYBOOKS_JSONL):
+            with open(LEGACY_STORYBOOKS_JSONL, 'rb') as f:
+                for line in f:
+                    if line.strip():
+                        legacy.append(json_loads(line))
+        elif os.path.exists(LEGACY_STORYBOOKS_FILE):
+            with open(LEGACY_STORYBOOKS_FILE, 'rb') as f:
+                legacy = json_loads(f.read()).get('storybooks', [])
+    except (IOError, ValueError) as e:
+        app.logger.error(f"Error migrating legacy storybooks: {str(e)}")
+    if legacy:
+        conn.executemany(
+            'INSERT OR IGNORE INTO storybooks VALUES (?, ?, ?)',
+            [(sb.get('path'), sb.get('title'),
+              json_dumps(sb.get('all_images', [])).decode('utf-8')) for sb in legacy])
+        conn.commit()
+        app.logger.info(f"Migrated {len(legacy)} storybooks into {STORYBOOKS_DB}.")
+
+def get_db():
+    '''
+    - Returns the shared SQLite connection, opening it on first use
+    - Enables WAL journaling and creates the storybooks table
+    - Imports storybooks from the legacy JSON files on first open
+    '''
+    global DB_CONN
+    if DB_CONN is None:
+        with STORYBOOKS_LOCK:
+            if DB_CONN is None:
+                conn = sqlite3.connect(STORYBOOKS_DB, check_same_thread=False)
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute('PRAGMA synchronous=NORMAL')
+                conn.execute('CREATE TABLE IF NOT EXISTS storybooks ('
+                             'path TEXT PRIMARY KEY, title TEXT, images TEXT)')
+                conn.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                             'id TEXT PRIMARY KEY, state TEXT, path TEXT, error TEXT)')
+                migrate_legacy_storybooks(conn)
+                DB_CONN = conn
+    return DB_CONN
 
 @app.before_first_request
 def initialize_app():
     '''
     - Runs before the first request to the app
-    - Creates 'storybooks.json' if it doesn't exist
-    - Logs the creation or existence of the file
+    - Opens 'storybooks.db', creating and migrating it if needed
     '''
-    if not os.path.exists(STORYBOOKS_FILE):
-        with open(STORYBOOKS_FILE, 'w') as file:
-            json.dump({'storybooks': []}, file)
-        app.logger.info(f'{STORYBOOKS_FILE} created.')
-    else:
-        app.logger.info(f'{STORYBOOKS_FILE} already exists.')
+    get_db()
+    app.logger.info(f'{STORYBOOKS_DB} ready.')
 
-@cache.memoize(timeout=300)
 def load_storybooks():
     '''
-    - Cached function to reduce file I/O
-    - Reads and parses the 'storybooks.json' file
+    - Reads all storybooks from SQLite, newest first
     - Returns an empty list if there's an error
     '''
     try:
-        with open(STORYBOOKS_FILE, 'r') as f:
-            data = json.load(f)
-            return data.get('storybooks', [])
-    except (IOError, json.JSONDecodeError) as e:
+        conn = get_db()
+        with STORYBOOKS_LOCK:
+            rows = conn.execute('SELECT title, path, images FROM storybooks '
+                                'ORDER BY rowid DESC').fetchall()
+        return [{'title': title, 'path': path, 'all_images': json_loads(images)}
+                for title, path, images in rows]
+    except Exception as e:
         app.logger.error(f"Error loading storybooks: {str(e)}")
         return []
 
+def storybook_image_urls(storybook):
+    '''
+    - Builds static-file URLs for a storybook's images
+    - Flask's static handler serves them without passing bytes through Python
+    - Handles legacy entries that stored full file paths
+    '''
+    path = storybook['path'].replace(os.sep, '/')
+    return [url_for('static', filename=f"{path}/{os.path.basename(image)}")
+            for image in storybook['all_images']]
+
 def save_storybook(title, output_dir,all_images):
     '''
-    - Loads existing storybooks
-    - Adds new storybook with title, path, and image paths
-    - Writes updated data back to 'storybooks.json'
+    - Adds new storybook with title, path, and image basenames
+    - A single O(1) insert regardless of how many storybooks exist
+    - Returns the saved storybook entry
     '''
     try:
-        storybooks = load_storybooks()
         relative_path = os.path.relpath(output_dir, app.static_folder)
-        storybooks.append({'title': title, 'path': relative_path, 'all_images':all_images})
-        with open(STORYBOOKS_FILE, 'w') as f:
-            json.dump({'storybooks': storybooks}, f)
+        image_names = [os.path.basename(image) for image in all_images]
+        storybook = {'title': title, 'path': relative_path, 'all_images':image_names}
+        conn = get_db()
+        with STORYBOOKS_LOCK:
+            conn.execute('INSERT OR REPLACE INTO storybooks VALUES (?, ?, ?)',
+                         (relative_path, title, json_dumps(image_names).decode('utf-8')))
+            conn.commit()
         app.logger.info(f"Storybook '{title}' saved successfully.")
+        return storybook
     except Exception as e:
         app.logger.error(f"Error saving storybook: {str(e)}")
 
@@ -93,73 +182,108 @@ def index():
 
 def get_all_file_paths(directory):
     '''
-    - Walks through the directory tree
-    - Collects all file paths
+    - Scans the (flat) storybook directory with os.scandir
+    - Collects all file paths without extra stat calls
     - Returns a list of file paths
     '''
     try:
-        file_paths = []
-        for root, _, files in os.walk(directory):
-            for filename in files:
-                filepath = os.path.join(root, filename)
-                file_paths.append(filepath)
-        return file_paths
+        return [entry.path for entry in os.scandir(directory) if entry.is_file()]
     except Exception as e:
         app.logger.error(f"Error getting file paths: {str(e)}")
         return []
 
-@cache.memoize(timeout=300)
-def generate_story(prompt):
+def generate_story_job(prompt):
     '''
-    - Cached function to avoid regenerating the same story
+    - Runs the full generation pipeline on a background thread
     - Calls generate_content() and process_text()
-    - Saves the generated storybook
-    - Renders the story template with generated content
+    - Saves the generated storybook and returns its entry
+    '''
+    text = generate_content(prompt)
+    result, output_dir, title = process_text(text)
+    if not output_dir or not os.path.exists(output_dir):
+        raise ValueError("Invalid output directory")
+
+    al_image_complete_paths = get_all_file_paths(output_dir)
+    storybook = save_storybook(title,output_dir, al_image_complete_paths )
+    if storybook is None:
+        raise ValueError("Failed to save storybook")
+    return storybook
+
+def run_story_job(job_id, prompt):
+    '''
+    - Executes the generation pipeline on the background pool
+    - Records the outcome in the jobs table for any worker to read
     '''
     try:
-        text = generate_content(prompt)
-        try:
-            content = json.loads(text)
-        except json.JSONDecodeError:
-            content = {"title": "Generated Story", "story": text}
-
-        result, output_dir, title = process_text(text)
-        if not output_dir or not os.path.exists(output_dir):
-            raise ValueError("Invalid output directory")
-
-        image_files = [f for f in os.listdir(output_dir) if f.endswith('.png')]
-        image_paths = [os.path.join(os.path.basename(output_dir), f) for f in image_files]
-        
-
-        al_image_complete_paths = get_all_file_paths(output_dir)
-        save_storybook(title,output_dir, al_image_complete_paths )
-        
-        return render_template('story.html', title=title, images=al_image_complete_paths)
+        storybook = generate_story_job(prompt)
+        state, path, error = 'done', storybook['path'], None
     except Exception as e:
         app.logger.error(f"Error generating story: {str(e)}")
-        flash(f"An error occurred while generating the story: {str(e)}", 'error')
+        state, path, error = 'error', None, str(e)
+    conn = get_db()
+    with STORYBOOKS_LOCK:
+        conn.execute('UPDATE jobs SET state=?, path=?, error=? WHERE id=?',
+                     (state, path, error, job_id))
+        conn.commit()
+
+def generate_story(prompt):
+    '''
+    - Registers a pending job and submits the pipeline to the background pool
+    - Redirects to the status page so the HTTP worker is freed immediately
+    - Repeated prompts hit the on-disk content cache and finish quickly
+    '''
+    job_id = uuid.uuid4().hex
+    conn = get_db()
+    with STORYBOOKS_LOCK:
+        conn.execute('INSERT INTO jobs VALUES (?, ?, NULL, NULL)', (job_id, 'pending'))
+        conn.commit()
+    STORY_EXECUTOR.submit(run_story_job, job_id, prompt)
+    return redirect(url_for('story_status', job_id=job_id))
+
+@app.route('/status/<job_id>')
+def story_status(job_id):
+    '''
+    - Reports the state of a background story job from the jobs table
+    - Refreshes itself while the job is running
+    - Evicts the finished job and redirects to the saved storybook
+    '''
+    conn = get_db()
+    with STORYBOOKS_LOCK:
+        row = conn.execute('SELECT state, path, error FROM jobs WHERE id=?',
+                           (job_id,)).fetchone()
+    if row is None:
+        flash("Unknown story job. Please try again.", 'error')
+        return redirect(url_for('index'))
+    state, path, error = row
+    if state == 'pending':
+        return ('<!DOCTYPE html><html><head><meta http-equiv="refresh" content="3" />'
+                '<title>Generating...</title></head>'
+                '<body><p>Your storybook is being generated. This page refreshes automatically.</p>'
+                '</body></html>')
+    # Finished either way: drop the job row; the storybook itself is in SQLite
+    with STORYBOOKS_LOCK:
+        conn.execute('DELETE FROM jobs WHERE id=?', (job_id,))
+        conn.commit()
+    if state == 'error':
+        flash(f"An error occurred while generating the story: {error}", 'error')
         return redirect(url_for('index'))
+    return redirect(url_for('view_storybook', relative_path=path))
 
 @app.route('/storybook/<path:relative_path>')
 def view_storybook(relative_path):
     '''
-    - Finds the storybook data in 'storybooks.json'
+    - Looks up the storybook by path with an indexed SQLite query
     - Retrieves images and title for the storybook
     - Renders the story template with the storybook data
     '''
     try:
-        def find_dict_by_path(file_path, search_value):
-            with open(STORYBOOKS_FILE, 'r') as f:
-                data = json.load(f)
-                
-
-            for item in data.get('storybooks', []):
-                if item.get('path') == search_value:
-                    return item["all_images"] ,item['title'],item["path"]
-                
-        images , title , path = find_dict_by_path(STORYBOOKS_FILE , relative_path)
-        
-        return render_template('story.html', title=title, images= images)
+        conn = get_db()
+        with STORYBOOKS_LOCK:
+            row = conn.execute('SELECT title, images FROM storybooks WHERE path=?',
+                               (relative_path,)).fetchone()
+        storybook = {'title': row[0], 'path': relative_path, 'all_images': json_loads(row[1])}
+
+        return render_template('story.html', title=storybook['title'], images=storybook_image_urls(storybook))
     except Exception as e:
         app.logger.error(f"Error viewing storybook: {str(e)}")
         flash("An error occurred while viewing the storybook. Please try again.", 'error')
@@ -10,19 +10,22 @@
 ## Please read README.md before proceeding further
 
 import os
+import hashlib
 import random
 import requests
 import base64
 import json
 import re
-import shutil
+import threading
 import time
 import logging
 from typing import List, Tuple
 from PIL import Image, ImageDraw, ImageFont
 import textwrap
-from functools import lru_cache
+from functools import lru_cache, wraps
 from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -36,11 +39,99 @@ IMAGE_MODELS = ["prompthero/openjourney", "stabilityai/stable-diffusion-xl-base-
 # Pre-load font
 FONT = ImageFont.truetype("PlayfairDisplaySC-Regular.otf", 30)
 
-@lru_cache(maxsize=100)
+# Throwaway draw object used only to measure text, so layout can be
+# computed without touching the page being captioned
+MEASURE_DRAW = ImageDraw.Draw(Image.new('RGBA', (1, 1)))
+
+# Shared pool for per-page work; the semaphore caps concurrent image API
+# calls so parallel stories can't exceed the provider's rate limits
+EXECUTOR = ThreadPoolExecutor(max_workers=4)
+IMAGE_SEMAPHORE = threading.Semaphore(4)
+
+# Shared HTTP session so API calls reuse pooled TCP+TLS connections instead
+# of paying a handshake per request; sized for the parallel image workers.
+# The adapter does no retries of its own - with_retry owns the backoff.
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=Retry(total=0)))
+
+# On-disk cache for generated story content; survives restarts unlike lru_cache
+CONTENT_CACHE_DIR = os.path.join('cache', 'content')
+
+# Strips characters that would break folder names derived from story titles
+TITLE_SANITIZE = re.compile(r'[?;:%#@*&\^$!<>,\\/]+')
+
+# Reused decoder for pulling the story JSON out of surrounding LLM prose
+JSON_DECODER = json.JSONDecoder()
+
+def is_retryable_error(error: Exception) -> bool:
+    '''
+    - Classifies an exception as a transient API failure
+    - HTTP 429/5xx, connection errors and rate-limit messages qualify
+    '''
+    if isinstance(error, requests.HTTPError):
+        status = error.response.status_code if error.response is not None else None
+        return status == 429 or (status is not None and status >= 500)
+    if isinstance(error, requests.RequestException):
+        return True
+    message = str(error).lower()
+    return 'rate limit' in message or 'quota' in message
+
+
+def with_retry(max_attempts: int = 3, base: float = 1.0, cap: float = 30.0):
+    '''
+    - Retries transient API failures with exponential backoff
+    - Doubles the wait per attempt, capped, plus jitter so parallel
+      workers don't retry in lockstep
+    - Re-raises immediately for non-transient errors
+    '''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            for attempt in range(max_attempts):
+                try:
+                    return func(*args, **kwargs)
+                except Exception as e:
+                    if attempt == max_attempts - 1 or not is_retryable_error(e):
+                        raise
+                    wait = min(cap, base * 2 ** attempt) + random.uniform(0, 0.25)
+                    logging.warning(f"{func.__name__} failed ({str(e)}); retrying in {wait:.2f}s")
+                    time.sleep(wait)
+        return wrapper
+    return decorator
+
+
+def disk_cached_content(func):
+    '''
+    - Cache-aside wrapper keyed on a blake2b digest of the arguments
+    - Hits read cache/content/<hex2>/<hex>.json instead of calling the API
+    - Misses call through and write the result atomically (temp + os.replace)
+    '''
+    @wraps(func)
+    def wrapper(prompt, model=0, temp=0.7, top_p=0.5):
+        key = hashlib.blake2b(f"{model}|{temp}|{top_p}|{prompt}".encode(), digest_size=16).hexdigest()
+        path = os.path.join(CONTENT_CACHE_DIR, key[:2], f"{key}.json")
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return f.read()
+        except IOError:
+            pass
+        result = func(prompt, model, temp, top_p)
+        if result:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(result)
+            os.replace(tmp_path, path)
+        return result
+    return wrapper
+
+
+@disk_cached_content
+@with_retry()
 def generate_content(prompt:str, model: int = 0,temp:float=0.7,top_p:float=0.5) -> str:
     '''
     - Constructs a detailed prompt for story generation
-    - Sends a request to an AI model API 
+    - Sends a request to an AI model API via the pooled SESSION
     - Handles potential errors in API communication
     - Returns the generated text or an error message
     '''
@@ -48,9 +139,10 @@ def generate_content(prompt:str, model: int = 0,temp:float=0.7,top_p:float=0.5)
     pass
 
 
+@with_retry()
 def generate_image(model: str, prompt: str, negative_prompt: str, title: str, image_index:int) -> List[str]:
     '''
-    - Sends a request to an image generation API
+    - Sends a request to an image generation API via the pooled SESSION
     - Handles the API response and potential errors
     - Decodes and saves the generated image
     - Returns the path of the saved image
@@ -59,49 +151,65 @@ def generate_image(model: str, prompt: str, negative_prompt: str, title: str, im
     pass
 
 
-def add_text_to_image(image_path, text, output_path):
+def generate_image_limited(model: str, prompt: str, negative_prompt: str, title: str, image_index:int) -> List[str]:
+    '''
+    - Calls generate_image under the global concurrency cap
+    - Safe to submit from the thread pool for every page at once
+    '''
+    with IMAGE_SEMAPHORE:
+        return generate_image(model, prompt, negative_prompt, title, image_index)
+
+
+@lru_cache(maxsize=256)
+def get_wrapped_layout(width: int, height: int, text: str) -> Tuple[str, Tuple[float, float], Tuple[float, float, float, float]]:
+    '''
+    - Wraps the caption and measures it against the page dimensions
+    - Returns the wrapped text, text position and caption box
+    - Cached: pages of one model share dimensions, so repeated captions
+      skip the wrap and font-metric work entirely
+    '''
+    wrapped_text = textwrap.fill(text, width=40)
+    text_bbox = MEASURE_DRAW.multiline_textbbox((0, 0), wrapped_text, font=FONT)
+    text_width = text_bbox[2] - text_bbox[0]
+    text_height = text_bbox[3] - text_bbox[1]
+    text_position = ((width - text_width) / 2, height - text_height - 20)
+    box_position = (text_position[0] - 10, text_position[1] - 10,
+                    text_position[0] + text_width + 10, text_position[1] + text_height + 10)
+    return wrapped_text, text_position, box_position
+
+
+def add_text_to_image(image, text, output_path):
     '''
-    - Opens an image file and creates a drawing object
+    - Accepts a file path or an already-open PIL image
     - Calculates text size and position
     - Adds a semi-transparent background behind the text
     - Writes the text on the image and saves it
 
     '''
     try:
-        # Open the image
-        img = Image.open(image_path)
-
-        # Create a drawing object
-        draw = ImageDraw.Draw(img)
+        # Open the image if given a path; ensure RGBA so the text box blends,
+        # skipping the conversion pass when the source is RGBA already
+        img = image if isinstance(image, Image.Image) else Image.open(image)
+        if img.mode != 'RGBA':
+            img = img.convert('RGBA')
 
-        # Load a font
-        font = FONT
-
-        # Set maximum width for text wrapping
-        max_width = img.width - 40
-
-        # Wrap the text
-        wrapped_text = textwrap.fill(text, width=40)
-
-        # Calculate text size and position
-        text_bbox = draw.multiline_textbbox((0, 0), wrapped_text, font=font)
-        text_width = text_bbox[2] - text_bbox[0]
-        text_height = text_bbox[3] - text_bbox[1]
-        text_position = ((img.width - text_width) / 2, img.height - text_height - 20)
+        # Wrap and place the caption; cached across same-size pages
+        wrapped_text, text_position, box_position = get_wrapped_layout(img.width, img.height, text)
 
         # Get background color from image
         bg_color = img.getpixel((int(text_position[0]), int(text_position[1])))
 
-        # Add semi-transparent text box
-        box_position = (text_position[0] - 10, text_position[1] - 10,
-                        text_position[0] + text_width + 10, text_position[1] + text_height + 10)
-        draw.rectangle(box_position, fill=(*bg_color, 128))
+        # Composite a semi-transparent text box in one C-level blend pass
+        overlay = Image.new('RGBA', img.size, (0, 0, 0, 0))
+        ImageDraw.Draw(overlay).rectangle(box_position, fill=(*bg_color[:3], 128))
+        img = Image.alpha_composite(img, overlay)
 
         # Add text
-        draw.multiline_text(text_position, wrapped_text, font=font, fill=(255, 255, 255, 255), align='center')
+        draw = ImageDraw.Draw(img)
+        draw.multiline_text(text_position, wrapped_text, font=FONT, fill=(255, 255, 255, 255), align='center')
 
-        # Save the image
-        img.save(output_path)
+        # Save as WebP: much faster to encode than PNG and 3-5x smaller to serve
+        img.save(output_path, format='WEBP', quality=85, method=4)
 
         # Return the modified image
         return output_path
@@ -113,20 +221,20 @@ def add_text_to_image(image_path, text, output_path):
 
 def extract_story_elements(full_text:str)-> Tuple[str, str, str, List[str]]:
     '''
-    - Finds and extracts the JSON string from the full text
-    - Parses the JSON data
+    - Finds the start of the JSON object in the full text
+    - Parses it in a single pass with raw_decode
     - Returns extracted elements as a tuple
     '''
     try:
-        # Extract JSON string from the full text
+        # Parse the first JSON object; raw_decode stops at its end, so any
+        # trailing prose after the object is ignored without a second scan
         json_start = full_text.find('{')
-        json_end = full_text.rfind('}') + 1
-        json_string = full_text[json_start:json_end]
-        # Parse JSON
-        story_data = json.loads(json_string)
+        if json_start == -1:
+            raise ValueError("no JSON object in generated text")
+        story_data, _ = JSON_DECODER.raw_decode(full_text, json_start)
         return story_data['title'], story_data['story'], story_data['moral'], story_data['imagePrompts']
-    
-    except (json.JSONDecodeError, KeyError) as e:
+
+    except (ValueError, KeyError) as e:
         logging.error(f"Error extracting story elements: {str(e)}")
         raise
 
@@ -136,14 +244,13 @@ def process_text(text:str)-> Tuple[List[str], str, str]:
     - Combines sentences and creates new image prompts
     - Generates images for each part of the story
     - Adds text to images to create storybook pages
-    - Moves final images to an output directory
+    - Writes final images directly into the output directory
     - Returns paths of created images, output directory, and story title
     '''
 
     try:
         title_raw, story, moral, image_prompts = extract_story_elements(text)
-        replace_special_chars = lambda s: re.sub(r'[?;:%#@*&\^$!<>,\\/]+', ' ', s)
-        title = replace_special_chars(title_raw)
+        title = TITLE_SANITIZE.sub(' ', title_raw)
         sentences = story.split('. ')
         combined_sentences = []
         image_prompt_new = []
@@ -163,19 +270,17 @@ def process_text(text:str)-> Tuple[List[str], str, str]:
         os.makedirs(output_dir, exist_ok=True)
         
         
-        for i, prompt in enumerate(image_prompt_new):
-            image_path = generate_image(IMAGE_MODELS[0], prompt, "", title, i)  
-            image_generated_paths.append(image_path)
-
-        # Combine text and image paths
-        combined_story_with_images = []
+        # Generate all pages in parallel; futures keep the page order
+        futures = [EXECUTOR.submit(generate_image_limited, IMAGE_MODELS[0], prompt, "", title, i)
+                   for i, prompt in enumerate(image_prompt_new)]
+        image_generated_paths = [future.result() for future in futures]
 
+        # Caption pages in parallel, writing each one straight into output_dir
+        futures = []
         for i, (text, image_path) in enumerate(zip(combined_sentences, image_generated_paths)):
-                story_with_image = add_text_to_image(image_path, text, f"image_new_{i}.png")
-                output_img_path = os.path.join(output_dir, f"image_new_{i}.png")
-                shutil.move(story_with_image, output_img_path)
-                combined_story_with_images.append(output_img_path)
-
+            output_img_path = os.path.join(output_dir, f"image_new_{i}.webp")
+            futures.append(EXECUTOR.submit(add_text_to_image, image_path, text, output_img_path))
+        combined_story_with_images = [future.result() for future in futures]
 
         return combined_story_with_images , output_dir, title
     
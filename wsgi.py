@@ -0,0 +1,7 @@
+# WSGI entry point for production servers
+# Run with: gunicorn -k gthread -w 2 --threads 8 -b 0.0.0.0:5000 wsgi:app
+
+from app import app
+
+if __name__ == '__main__':
+    app.run(host='0.0.0.0', port=5000)